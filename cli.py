@@ -1,16 +1,21 @@
 import os
 import sys
 import time
+import sqlite3
 import logging
 import argparse
 import datetime
-from common import ChangeLog
+from common import ChangeLog, HashCache, walk_entries
 from naming import STYLE_NAMES, rename_dir
 from empties import remove_empty
 from duplicates import remove_duplicates
 
 
 DESCRIPTION = 'fsclean v1.1 by Jacob Jewett'
+DEFAULT_HASH_CACHE_PATH = os.path.join(os.path.expanduser('~'),
+                                       '.cache',
+                                       'fsclean',
+                                       'hashes.sqlite3')
 
 DEV_FORMATTER = logging.Formatter('[{asctime}] {levelname:>8}: {message} '
                                   '[{name}@{lineno}]',
@@ -41,18 +46,13 @@ def timing_counter():
 
 
 def pretty_ms(milliseconds):
-    if milliseconds is not None:
-        if milliseconds <= 1000:
-            if isinstance(milliseconds, float):
-                return '{:04.2f}ms'.format(milliseconds)
-            return '{:04d}ms'.format(milliseconds)
-        elif 1000 < milliseconds <= 60000:
-            seconds = milliseconds / 1000
-            return '{:02.2f}s'.format(seconds)
-        elif milliseconds > 60000:
-            minutes = milliseconds / 60000
-            return '{:02.2f}min'.format(minutes)
-    return None
+    if milliseconds is None:
+        return None
+    if milliseconds <= 1000:
+        return f'{milliseconds:04.2f}ms'
+    if milliseconds <= 60000:
+        return f'{milliseconds / 1000:02.2f}s'
+    return f'{milliseconds / 60000:02.2f}min'
 
 NAMING_OPERATION = 'naming'
 EMPTIES_OPERATION = 'empties'
@@ -62,6 +62,13 @@ OPERATION_NAMES = [
     EMPTIES_OPERATION,
     DUPLICATES_OPERATION
 ]
+# empty files are removed before duplicates are searched, renaming comes
+# last so it does not touch files that are about to be removed
+OPERATION_ORDER = [
+    EMPTIES_OPERATION,
+    DUPLICATES_OPERATION,
+    NAMING_OPERATION
+]
 
 
 if __name__ == '__main__':
@@ -84,6 +91,13 @@ if __name__ == '__main__':
                     help='enable and set path for JSON log of '
                          'changes made by this program. '
                          'default filename is "changelog.json".')
+    ap.add_argument('--hash-cache', '-H',
+                    nargs='?',
+                    dest='hash_cache_path',
+                    const=DEFAULT_HASH_CACHE_PATH,
+                    help='enable and set path for a database of file hashes '
+                         'reused by later duplicate searches. default path is '
+                         f'"{DEFAULT_HASH_CACHE_PATH}".')
     ap.add_argument('--dry', '-d',
                     action='store_true',
                     dest='dry_run',
@@ -123,6 +137,7 @@ if __name__ == '__main__':
 
     operations_text = apr.operations[0]
     changelog_path = apr.changelog_path
+    hash_cache_path = apr.hash_cache_path
     targets = apr.targets
     dry_run = apr.dry_run
     recursive = apr.recursive
@@ -139,16 +154,49 @@ if __name__ == '__main__':
     if recursive:
         LOG.info('recursive search enabled')
 
-    # prepare a new instance of a ChangeLog to record changes to files
-    cl = ChangeLog()
+    # prepare a new instance of a ChangeLog to record changes to files,
+    # streamed next to the changelog when there are too many to hold in memory
+    try:
+        if changelog_path is not None:
+            cl = ChangeLog(stream_path=f'{changelog_path}.part')
+        else:
+            cl = ChangeLog()
+    except IOError as e:
+        LOG.error(f'could not write changelog to "{changelog_path}": '
+                  f'{str(e)}')
+        exit(2)
+
+    hash_cache = None
+    if hash_cache_path is not None:
+        LOG.info(f'using hash cache "{hash_cache_path}"')
+        try:
+            hash_cache = HashCache(hash_cache_path)
+        except (OSError, sqlite3.Error) as e:
+            LOG.error(f'could not open hash cache "{hash_cache_path}": '
+                      f'{str(e)}')
 
     # record time before starting the operations
     start = datetime.datetime.now()
     stopwatch = timing_counter()
 
-    operations = operations_text.split(',')
+    operations = []
+    for op in operations_text.split(','):
+        if op.lower() in OPERATION_NAMES:
+            operations.append(op.lower())
+        else:
+            LOG.warning(f'ignoring unknown operation "{op}"')
+
     bytes_freed = 0
 
+    style = None
+    if NAMING_OPERATION in operations and style_text is not None:
+        style_text = style_text.strip().lower()
+
+        if style_text not in STYLE_NAMES:
+            LOG.warning(f'ignoring unknown style "{style_text}"')
+        else:
+            style = style_text
+
     valid_targets = []
     for target in targets:
         if not os.path.isdir(target):
@@ -156,47 +204,73 @@ if __name__ == '__main__':
         else:
             valid_targets.append(target)
 
-    for op in operations:
-        if op.lower() == NAMING_OPERATION:
-            # filename consistency normalizer routine.
-            LOG.info('operation: filename consistency')
-
-            style = None
-            if style_text is not None:
-                style_text = style_text.strip().lower()
-
-                if style_text not in STYLE_NAMES:
-                    LOG.warning(f'ignoring unknown style "{style_text}"')
-                else:
-                    style = style_text
+    def list_failed(e: OSError):
+        LOG.error(f'failed to list directory "{e.filename}": {str(e)}')
+
+        # recorded the way remove_empty() does when it walks by itself
+        if EMPTIES_OPERATION in operations:
+            cl.addChange(EMPTIES_OPERATION,
+                         False,
+                         path=e.filename,
+                         message=str(e),
+                         errno=e.errno)
+
+    # only the removal operations need file sizes
+    stat_files = EMPTIES_OPERATION in operations or \
+        DUPLICATES_OPERATION in operations
+
+    for target in valid_targets:
+        if not operations:
+            break
+
+        # walk the target once and share the listing between operations,
+        # each operation takes out what it removed for the ones after it
+        LOG.info(f'scanning "{target}"')
+        listings = list(walk_entries(target,
+                                     recursive,
+                                     list_failed,
+                                     stat_files=stat_files))
+
+        for op in OPERATION_ORDER:
+            if op not in operations:
+                continue
+
+            if op == EMPTIES_OPERATION:
+                # empty files and dirs routine.
+                LOG.info('operation: empty files and directories')
+
+                remove_empty(cl, target, dry_run, recursive,
+                             listings=listings)
+            elif op == DUPLICATES_OPERATION:
+                # duplicate search routine.
+                LOG.info('operation: duplicate search')
 
-            for target in valid_targets:
-                rename_dir(cl, target, dry_run, recursive,
-                           style=style, space_char=space_char)
-        elif op.lower() == EMPTIES_OPERATION:
-            # empty files and dirs routine.
-            LOG.info('operation: empty files and directories')
-
-            for target in valid_targets:
-                remove_empty(cl, target, dry_run, recursive)
-        elif op.lower() == DUPLICATES_OPERATION:
-            # duplicate search routine.
-            LOG.info('operation: duplicate search')
-
-            for target in valid_targets:
                 bytes_freed += remove_duplicates(cl,
                                                  target,
                                                  dry_run,
-                                                 recursive)
+                                                 recursive,
+                                                 cache=hash_cache,
+                                                 listings=listings)
+            elif op == NAMING_OPERATION:
+                # filename consistency normalizer routine.
+                LOG.info('operation: filename consistency')
 
-        else:
-            LOG.warning(f'ignoring unknown operation "{op}"')
+                rename_dir(cl, target, dry_run, recursive,
+                           style=style, space_char=space_char,
+                           listings=listings)
+
+    if hash_cache is not None:
+        try:
+            hash_cache.close()
+        except sqlite3.Error as e:
+            LOG.error(f'could not update hash cache "{hash_cache_path}": '
+                      f'{str(e)}')
 
     job_time = timing_counter() - stopwatch
     # format the duration message
     duration_text = pretty_ms(job_time)
 
-    LOG.info('{} changes in {}'.format(len(cl.changes), duration_text))
+    LOG.info('{} changes in {}'.format(cl.counter, duration_text))
 
     # add version and statistics to root object of JSON file
     cl.addRootProperties({
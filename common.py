@@ -1,4 +1,38 @@
+import os
 import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# directories of a tree level are only listed in parallel past this count
+PARALLEL_WALK_THRESHOLD = 4
+WALK_WORKERS = os.cpu_count() or 1
+# number of changes held in memory before a change log starts streaming
+STREAM_THRESHOLD = 10000
+# number of changes held in memory between writes once it streams
+STREAM_BUFFER_SIZE = 1000
+
+
+def dumps(obj) -> str:
+    """
+    Encode an object as compact JSON, using orjson when installed and able
+    to encode it
+    :param obj: the object to encode
+    :return: the JSON text
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            # orjson refuses the lone surrogates that file names which are
+            # not valid UTF-8 are decoded into
+            pass
+    return json.dumps(obj)
 
 
 class ChangeLog:
@@ -9,7 +43,7 @@ class ChangeLog:
     @property
     def changes(self):
         """
-        :return: the list of changes
+        :return: the list of changes not yet written to the stream file
         """
         return self._changes
 
@@ -18,14 +52,25 @@ class ChangeLog:
         """
         :return: the total number of recorded changes
         """
-        return self._counter
+        return self._streamed + len(self._changes)
 
-    def __init__(self):
-        self._counter = 0
+    def __init__(self, stream_path: str = None):
+        """
+        :param stream_path: optional file that changes are written to in
+        batches, one JSON object per line, once more than STREAM_THRESHOLD
+        are recorded, instead of keeping all of them in memory until save()
+        """
+        self._streamed = 0
         self._changes = []
         self._root = {
             'changes': self._changes
         }
+        self._stream = None
+        # number of changes held before the next write to the stream file
+        self._flush_at = STREAM_THRESHOLD
+
+        if stream_path is not None:
+            self._stream = open(stream_path, 'w', encoding='utf-8')
 
     def addChange(self, operation: str, executed: bool, **kwargs):
         """
@@ -34,14 +79,35 @@ class ChangeLog:
         :param executed: Weather the action was carried out
         :param kwargs: Any related data that will be appended
         """
-        change = {
-            'id': self._counter,
+        self._changes.append({
+            'id': self._streamed + len(self._changes),
             'operation': operation,
-            'executed': executed
-        }
-        change.update(kwargs)
-        self._changes.append(change)
-        self._counter += 1
+            'executed': executed,
+            **kwargs
+        })
+
+        if self._stream is not None and \
+                len(self._changes) > self._flush_at:
+            self.flush()
+
+    def addChanges(self, operation: str, changes):
+        """
+        Record several operations of the same kind at once
+        :param operation: Arbitrary name of the operations
+        :param changes: an iterable of (executed, properties) tuples, the
+        properties being a dictionary of related data as given to addChange()
+        """
+        first_id = self._streamed + len(self._changes)
+        self._changes.extend({
+            'id': first_id + i,
+            'operation': operation,
+            'executed': executed,
+            **properties
+        } for i, (executed, properties) in enumerate(changes))
+
+        if self._stream is not None and \
+                len(self._changes) > self._flush_at:
+            self.flush()
 
     def addRootProperties(self, properties: dict):
         """
@@ -50,11 +116,245 @@ class ChangeLog:
         """
         self._root.update(properties)
 
+    def flush(self):
+        """
+        Write recorded changes to the stream file, if there is one
+        """
+        if self._stream is not None and self._changes:
+            # called from addChange() after a change was already made, so
+            # encoding must not fail on file names; dumps() falls back to
+            # json for the ones orjson refuses
+            self._stream.write(''.join(dumps(change) + '\n'
+                                       for change in self._changes))
+            self._stream.flush()
+            self._streamed += len(self._changes)
+            self._changes.clear()
+            self._flush_at = STREAM_BUFFER_SIZE
+
     def save(self, path: str, **kwargs):
         """
-        Write the changes to a file in JSON
+        Write the changes to a file in JSON. The document is encoded with
+        orjson in a single write when it is installed and able to encode it.
+
+        If changes were streamed, they are copied into the document one per
+        line instead. The stream file is removed either way.
         :param path: the path to write to
-        :param kwargs: parameters to pass to the JSON encoder
+        :param kwargs: parameters to pass to the JSON encoder, only `indent`
+        is considered when using orjson and none after streaming
         """
+        if self._stream is not None and not self._streamed:
+            # never needed, everything is still in memory
+            self._stream.close()
+            os.remove(self._stream.name)
+            self._stream = None
+
+        if self._stream is not None:
+            self.flush()
+
+            with open(self._stream.name, 'r', encoding='utf-8') as changes, \
+                    open(path, 'w', encoding='utf-8') as sf:
+                sf.write('{"changes": [')
+
+                for i, line in enumerate(changes):
+                    sf.write((',\n' if i else '\n') + line.rstrip('\n'))
+
+                sf.write('\n]')
+
+                for k, v in self._root.items():
+                    if k != 'changes':
+                        sf.write(f', {dumps(k)}: {dumps(v)}')
+
+                sf.write('}\n')
+
+            self._stream.close()
+            os.remove(self._stream.name)
+            self._stream = None
+            return
+
+        if orjson is not None:
+            option = orjson.OPT_INDENT_2 if kwargs.get('indent') else 0
+
+            try:
+                document = orjson.dumps(self._root, option=option)
+            except TypeError:
+                # lone surrogates of undecodable file names, see dumps()
+                document = None
+
+            if document is not None:
+                with open(path, 'wb') as sf:
+                    sf.write(document)
+                return
+
         with open(path, 'w') as sf:
             json.dump(self._root, sf, **kwargs)
+
+
+class HashCache:
+    """
+    A persistent store of file digests, keyed by device and inode number and
+    invalidated by changes to the file size or modification time
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._pending = []
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS digests ('
+                           'dev INTEGER NOT NULL, '
+                           'ino INTEGER NOT NULL, '
+                           'size INTEGER NOT NULL, '
+                           'mtime INTEGER NOT NULL, '
+                           'algorithm TEXT NOT NULL, '
+                           'digest BLOB NOT NULL, '
+                           'PRIMARY KEY (dev, ino))')
+
+    def get(self, st: os.stat_result, algorithm: str):
+        """
+        Look up the digest of an unchanged file
+        :param st: the current stat result of the file
+        :param algorithm: name of the hash algorithm of the digest
+        :return: the digest or None if unknown or outdated
+        """
+        if not st.st_ino:
+            return None
+
+        row = self._conn.execute('SELECT digest FROM digests '
+                                 'WHERE dev=? AND ino=? AND size=? AND '
+                                 'mtime=? AND algorithm=?',
+                                 (st.st_dev,
+                                  st.st_ino,
+                                  st.st_size,
+                                  st.st_mtime_ns,
+                                  algorithm)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, st: os.stat_result, algorithm: str, digest: bytes):
+        """
+        Queue the digest of a file to be stored on the next commit()
+        :param st: the stat result of the file at the time it was hashed
+        :param algorithm: name of the hash algorithm of the digest
+        :param digest: the digest bytes
+        """
+        if st.st_ino:
+            self._pending.append((st.st_dev,
+                                  st.st_ino,
+                                  st.st_size,
+                                  st.st_mtime_ns,
+                                  algorithm,
+                                  digest))
+
+    def commit(self):
+        """
+        Store all queued digests in a single transaction
+        """
+        if self._pending:
+            try:
+                with self._conn:
+                    self._conn.executemany('INSERT OR REPLACE INTO digests '
+                                           'VALUES (?, ?, ?, ?, ?, ?)',
+                                           self._pending)
+            finally:
+                # digests that failed to store are not retried
+                self._pending.clear()
+
+    def close(self):
+        """
+        Commit queued digests and close the database
+        """
+        self.commit()
+        self._conn.close()
+
+
+def scan_directory(directory: str, stat_files: bool = False):
+    """
+    List a single directory.
+    :param directory: the directory to list
+    :param stat_files: True to fetch the stat results of regular files
+    right away, while their directory was just read
+    :return: a tuple of (directory, sub-directory entries, other entries)
+    """
+    dirs = []
+    files = []
+
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                dirs.append(entry)
+            else:
+                files.append(entry)
+
+    if stat_files:
+        for entry in files:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    # DirEntry caches the result for later calls
+                    entry.stat(follow_symlinks=False)
+            except OSError:
+                # left for the caller to run into when it needs the result
+                pass
+
+    return directory, dirs, files
+
+
+def walk_entries(directory: str,
+                 recursive: bool,
+                 onerror=None,
+                 stat_files: bool = False):
+    """
+    Walk a directory tree, similar to os.walk() but yielding the os.DirEntry
+    objects so their cached type and stat information can be reused.
+    Symbolic links to directories are listed as files and never followed.
+
+    The tree is walked one level at a time, so a directory is always yielded
+    before any of its sub-directories. Levels with more than
+    PARALLEL_WALK_THRESHOLD directories are listed on a thread pool.
+    :param directory: the directory to start at
+    :param recursive: True to descend into sub-directories
+    :param onerror: optional function called with the OSError of a
+    directory that could not be listed
+    :param stat_files: True to fetch the stat results of regular files
+    while listing each directory
+    :return: a generator of (directory, sub-directory entries, other entries)
+    """
+    def scan(path: str):
+        try:
+            return scan_directory(path, stat_files)
+        except OSError as e:
+            return e
+
+    level = [directory]
+    executor = None
+
+    try:
+        while level:
+            if executor is None and len(level) > PARALLEL_WALK_THRESHOLD:
+                executor = ThreadPoolExecutor(max_workers=WALK_WORKERS)
+
+            listings = executor.map(scan, level) if executor else \
+                map(scan, level)
+            level = []
+
+            for listing in listings:
+                if isinstance(listing, OSError):
+                    if onerror is not None:
+                        onerror(listing)
+                    continue
+
+                yield listing
+
+                if recursive:
+                    level.extend(entry.path for entry in listing[1])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -1,12 +1,41 @@
 import os
-import filecmp
+import mmap
+import hashlib
+import sqlite3
 import logging
-from common import ChangeLog
+from concurrent.futures import ThreadPoolExecutor
+from common import ChangeLog, HashCache, walk_entries
 from collections import defaultdict
 
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+if blake3 is not None and not hasattr(blake3, 'update_mmap'):
+    # hashing files by memory mapping them needs blake3 0.4 or newer
+    blake3 = None
+
+# identifies the digests produced by hash_file() in the hash cache
+HASH_ALGORITHM = 'blake2b' if blake3 is None else 'blake3'
+
 
 LOG = logging.getLogger('fsclean.duplicates')
 
+# files up to this size are compared by their contents instead of digests
+SMALL_FILE_SIZE = 64 * 1024
+# limits how many small files are held in memory at once
+SMALL_FILE_BATCH = 1024
+# number of bytes at the start of a file compared before hashing it in full
+HEAD_SIZE = 4096
+# read size used when hashing whole files
+CHUNK_SIZE = 1024 * 1024
+# window size used when comparing two mapped files
+COMPARE_SIZE = 4 * 1024 * 1024
+# hashing is only spread across threads past this many candidate files
+PARALLEL_THRESHOLD = 4
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 
 def shortest_filenames(files: list):
     """
@@ -31,59 +60,335 @@ def shortest_filenames(files: list):
     return shortest, others
 
 
-def get_most_recent_file(files):
-    mod_map = defaultdict(str)
+def get_most_recent_file(files, stat_cache: dict = None):
+    if stat_cache is None:
+        return max(files, key=os.path.getmtime)
 
-    for file in files:
-        mod_time = os.path.getmtime(file)
-        # does not handle if two files have the exact same mod time
-        mod_map[mod_time] = file
+    return max(files, key=lambda file: stat_cache[file].st_mtime_ns)
+
+
+def read_file(path: str):
+    """
+    Read an entire file in one call.
+    :param path: path to the file
+    :return: the contents of the file
+    """
+    with open(path, 'rb') as fs:
+        return fs.read()
+
+
+def hash_head(path: str):
+    """
+    Compute a short digest of the first HEAD_SIZE bytes of a file.
+    :param path: path to the file
+    :return: the digest bytes
+    """
+    with open(path, 'rb') as fs:
+        return hashlib.blake2b(fs.read(HEAD_SIZE), digest_size=16).digest()
+
+
+def advise(fs, advice: str):
+    """
+    Hint the expected access pattern of an open file to the kernel, where
+    posix_fadvise() is supported.
+    :param fs: an open file object
+    :param advice: name of the os.POSIX_FADV_* constant
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fs.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            # only a hint, the file is read the same way without it
+            pass
+
+
+def hash_file(path: str):
+    """
+    Compute a digest of the entire contents of a file. BLAKE3 is used when
+    the blake3 package is installed, BLAKE2b otherwise. The file is dropped
+    from the page cache afterwards as it will not be read again.
+    :param path: path to the file
+    :return: the digest bytes
+    """
+    with open(path, 'rb') as fs:
+        advise(fs, 'POSIX_FADV_SEQUENTIAL')
+
+        if blake3 is not None:
+            hf = blake3(max_threads=blake3.AUTO)
+            hf.update_mmap(path)
+        else:
+            hf = hashlib.blake2b()
+            chunk = fs.read(CHUNK_SIZE)
+            while chunk:
+                hf.update(chunk)
+                chunk = fs.read(CHUNK_SIZE)
 
-    return mod_map[max(mod_map.keys())]
+        advise(fs, 'POSIX_FADV_DONTNEED')
 
+    return hf.digest()
+
+
+def map_file(fs):
+    """
+    Map an open file into memory for sequential reading.
+    :param fs: a file object opened for binary reading
+    :return: a read-only mmap object
+    """
+    m = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(m, 'madvise'):
+        m.madvise(mmap.MADV_SEQUENTIAL)
+
+    return m
+
+
+def files_equal(pair: list):
+    """
+    Compare the contents of two non-empty files directly.
+    :param pair: the paths of both files
+    :return: True if the contents are identical
+    """
+    a, b = pair
+
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        size = os.fstat(fa.fileno()).st_size
+
+        # either may have changed since it was listed, and empty files
+        # cannot be mapped
+        if size == 0 or size != os.fstat(fb.fileno()).st_size:
+            return False
+
+        with map_file(fa) as ma, map_file(fb) as mb:
+            equal = len(ma) == len(mb)
+
+            for offset in range(0, len(ma) if equal else 0, COMPARE_SIZE):
+                end = offset + COMPARE_SIZE
+
+                if ma[offset:end] != mb[offset:end]:
+                    equal = False
+                    break
+
+        advise(fa, 'POSIX_FADV_DONTNEED')
+        advise(fb, 'POSIX_FADV_DONTNEED')
+
+    return equal
+
+
+def skip_unreadable(key):
+    """
+    Wrap a key function so a file that cannot be read is left out of the
+    search instead of failing it.
+    :param key: a function returning the key of a path
+    :return: the wrapped key function
+    """
+    def wrapper(path: str):
+        try:
+            return key(path)
+        except OSError as e:
+            LOG.error(f'failed to read "{path}": {str(e)}')
+            # a key of its own leaves the file out of every group
+            return object()
 
-def list_except_one(l: list, o: object):
-    index = l.index(o)
-    return l[:index] + l[index + 1:]
+    return wrapper
+
+
+def regroup(groups: dict, key, executor=None):
+    """
+    Split groups of paths further by another key.
+    :param groups: a map of group keys to lists of paths
+    :param key: a function returning the key of a path
+    :param executor: optional executor used to compute keys in parallel
+    :return: a map of extended group keys to lists of more than one path
+    """
+    paths = [path for group in groups.values() for path in group]
+    keys = iter(executor.map(key, paths) if executor else map(key, paths))
+    result = defaultdict(list)
+
+    for group_key, group in groups.items():
+        for path in group:
+            result[group_key + (next(keys),)].append(path)
+
+    return {k: v for k, v in result.items() if len(v) > 1}
+
+
+def batches(groups: dict, limit: int):
+    """
+    Split a map of groups into smaller maps.
+    :param groups: a map of group keys to lists of paths
+    :param limit: the number of paths a batch may hold, only exceeded by
+    a single group larger than it
+    :return: a generator of maps of group keys to lists of paths
+    """
+    batch = {}
+    count = 0
+
+    for k, v in groups.items():
+        if batch and count + len(v) > limit:
+            yield batch
+            batch = {}
+            count = 0
+
+        batch[k] = v
+        count += len(v)
+
+    if batch:
+        yield batch
 
 
 def find_duplicates(directory: str,
-                    recursive: bool):
+                    recursive: bool,
+                    cache: HashCache = None,
+                    stat_cache: dict = None,
+                    listings: list = None):
     """
     Locate duplicate files starting at `directory`.
 
+    Files are only ever compared to others in the same folder. Candidates
+    are narrowed down by size first. Files of up to SMALL_FILE_SIZE bytes are
+    then grouped by their contents. Larger files are compared directly when
+    only two share a size, otherwise by a digest of their first HEAD_SIZE
+    bytes and finally by a digest of their whole contents. So are small
+    files when more than SMALL_FILE_BATCH of them share a size.
+
     :param directory: the folder to search
     :param recursive: True to recursively consider sub-directories
+    :param cache: optional HashCache to reuse and store whole file digests
+    :param stat_cache: optional dictionary filled with the stat results of
+    all files searched, keyed by path
+    :param listings: optional list of walk_entries() results for `directory`
+    to use instead of walking it again
     :return: a map of file paths to other duplicates
     """
     file_map = defaultdict(list)
 
-    try:
-        for cd, dirs, files in os.walk(directory, followlinks=False):
-            files = [os.path.join(cd, f) for f in files]
-            for file in files:
-                size = os.stat(file).st_size
-
-                if size > 0:
-                    pool = list_except_one(files, file)
-                    for other_file in pool:
-                        if other_file in file_map.keys():
+    if stat_cache is None:
+        stat_cache = {}
+
+    if listings is None:
+        listings = walk_entries(directory, recursive, stat_files=True)
+
+    by_size = defaultdict(list)
+
+    for cd, dirs, files in listings:
+        for entry in files:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    stat_cache[entry.path] = st
+                    size = st.st_size
+
+                    if size > 0:
+                        by_size[(cd, size)].append(entry.path)
+            except OSError as e:
+                LOG.error(f'failed to stat "{entry.path}": {str(e)}')
+
+    # groups too large to hold in memory are hashed like larger files
+    small = {k: v for k, v in by_size.items() if 1 < len(v) and
+             k[1] <= SMALL_FILE_SIZE and len(v) <= SMALL_FILE_BATCH}
+    large = {k: v for k, v in by_size.items() if 1 < len(v) and
+             (k[1] > SMALL_FILE_SIZE or len(v) > SMALL_FILE_BATCH)}
+    cached = {}
+    known = {}
+    stats = {}
+    hashed = {}
+
+    if cache is not None:
+        try:
+            for group in large.values():
+                for path in group:
+                    st = stat_cache[path]
+
+                    if not st.st_ino:
+                        # DirEntry leaves out the file index on Windows
+                        try:
+                            st = os.stat(path)
+                        except OSError as e:
+                            LOG.error(f'failed to stat "{path}": {str(e)}')
                             continue
 
-                        other_size = os.stat(other_file).st_size
+                    stats[path] = st
+                    digest = cache.get(st, HASH_ALGORITHM)
+
+                    if digest is not None:
+                        known[path] = digest
+        except sqlite3.Error as e:
+            # the cache only saves work, the search goes on without it
+            LOG.error(f'failed to read hash cache: {str(e)}')
+            cache = None
+
+        # sizes whose digests are all known skip straight to comparing them
+        cached = {k: v for k, v in large.items()
+                  if all(path in known for path in v)}
+        large = {k: v for k, v in large.items() if k not in cached}
+
+    def digest_file(path: str):
+        if path in known:
+            return known[path]
+
+        hashed[path] = hash_file(path)
+        return hashed[path]
+
+    def pair_equal(pair: list):
+        try:
+            return files_equal(pair)
+        except OSError as e:
+            LOG.error(f'failed to compare "{pair[0]}" and "{pair[1]}": '
+                      f'{str(e)}')
+            return False
+
+    pairs = {k: v for k, v in large.items() if len(v) == 2}
+    same_size = {k: v for k, v in large.items() if len(v) > 2}
+    candidates = sum(len(v) for v in small.values()) + \
+        sum(len(v) for v in large.values())
+    duplicates = []
+
+    executor = None
+    if candidates > PARALLEL_THRESHOLD:
+        executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+    try:
+        for batch in batches(small, SMALL_FILE_BATCH):
+            same_content = regroup(batch,
+                                   skip_unreadable(read_file),
+                                   executor)
+            duplicates.extend((cd, size, group)
+                              for (cd, size, _), group
+                              in same_content.items())
+
+        same_head = regroup(same_size, skip_unreadable(hash_head), executor)
+        same_head.update(cached)
+        same_content = regroup(same_head,
+                               skip_unreadable(digest_file),
+                               executor)
+        duplicates.extend((cd, size, group)
+                          for (cd, size, *_), group
+                          in same_content.items())
 
-                        if other_size == size:
-                            LOG.debug(f'content comparison on "{file}" <-> '
-                                      f'"{other_file}"')
-                            # cmp() includes comparison caching
-                            if filecmp.cmp(file, other_file):
-                                file_map[file].append(other_file)
+        pair_list = list(pairs.values())
+        equal = executor.map(pair_equal, pair_list) if executor else \
+            map(pair_equal, pair_list)
+        duplicates.extend((cd, size, pair)
+                          for ((cd, size), pair), eq
+                          in zip(pairs.items(), equal)
+                          if eq)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-            if not recursive:
-                break
-    except OSError as e:
-        LOG.error(
-            'failed to search "{}": {}'.format(directory, str(e)))
+    if cache is not None:
+        for path, digest in hashed.items():
+            if path in stats:
+                cache.put(stats[path], HASH_ALGORITHM, digest)
+
+        try:
+            cache.commit()
+        except sqlite3.Error as e:
+            LOG.error(f'failed to update hash cache: {str(e)}')
+
+    for cd, size, group in duplicates:
+        LOG.debug(f'identical content in {len(group)} files of '
+                  f'{size} bytes in "{cd}"')
+        file_map[group[0]].extend(group[1:])
 
     return file_map
 
@@ -91,26 +396,36 @@ def find_duplicates(directory: str,
 def remove_duplicates(cl: ChangeLog,
                       directory: str,
                       dry_run: bool,
-                      recursive: bool):
+                      recursive: bool,
+                      cache: HashCache = None,
+                      listings: list = None):
     """
     Find and remove file duplicates
     :param cl: ChangeLog instance
     :param directory: directory to search
     :param dry_run: True will not apply changes, only log them
     :param recursive: True to recursively consider sub-directories
+    :param cache: optional HashCache to reuse and store whole file digests
+    :param listings: optional list of walk_entries() results for `directory`
+    to use instead of walking it again, removed files are taken out of it
     """
     bytes_freed = 0
+    stat_cache = {}
+    removed = set()
 
     # Generate a dictionary of duplicate files
     file_map = find_duplicates(directory,
-                               recursive)
+                               recursive,
+                               cache,
+                               stat_cache,
+                               listings)
 
     # Remove all files but the one with the shortest file name
     for path, duplicates in file_map.items():
         # Determine the shortest file name
         shortest, others = shortest_filenames((duplicates + [path]))
         chosen_name = shortest[0] if len(shortest) == 1 else \
-            get_most_recent_file(shortest)
+            get_most_recent_file(shortest, stat_cache)
 
         LOG.info('"{}": {} duplicates found'.format(chosen_name,
                                                     len(others)))
@@ -122,20 +437,20 @@ def remove_duplicates(cl: ChangeLog,
 
             if not dry_run:
                 try:
-                    bytes_freed += os.stat(duplicate).st_size
-                    if os.path.exists(duplicate):
-                        os.remove(duplicate)
-                        cl.addChange(__name__,
-                                     True,
-                                     path=duplicate,
-                                     original=chosen_name)
-                    else:
-                        LOG.error(f'"{chosen_name}": duplicate does not exist')
-                        cl.addChange(__name__,
-                                     False,
-                                     path=duplicate,
-                                     original=chosen_name,
-                                     message='duplicate does not exist')
+                    os.remove(duplicate)
+                    bytes_freed += stat_cache[duplicate].st_size
+                    removed.add(duplicate)
+                    cl.addChange(__name__,
+                                 True,
+                                 path=duplicate,
+                                 original=chosen_name)
+                except FileNotFoundError:
+                    LOG.error(f'"{chosen_name}": duplicate does not exist')
+                    cl.addChange(__name__,
+                                 False,
+                                 path=duplicate,
+                                 original=chosen_name,
+                                 message='duplicate does not exist')
                 except OSError as e:
                     LOG.error(f'"{chosen_name}": failed to remove '
                               f'"{duplicate}": {str(e)}')
@@ -150,4 +465,9 @@ def remove_duplicates(cl: ChangeLog,
                              False,
                              path=duplicate,
                              original=chosen_name)
+
+    if listings is not None and removed:
+        for cd, dirs, files in listings:
+            files[:] = [entry for entry in files if entry.path not in removed]
+
     return bytes_freed
@@ -1,73 +1,149 @@
 import os
 import logging
-from common import ChangeLog
+from common import ChangeLog, walk_entries
 
 
 LOG = logging.getLogger('fsclean.empties')
 
 
+def is_empty(directory: str):
+    """
+    Check if a directory has no entries without listing all of them.
+    :param directory: path to the directory
+    :return: True if the directory is empty
+    """
+    with os.scandir(directory) as it:
+        return next(it, None) is None
+
+
+def remove_file(cl: ChangeLog, file: str, dry_run: bool):
+    """
+    Remove an empty file
+    :param cl: ChangeLog instance
+    :param file: path to the file
+    :param dry_run: True will not apply changes, only log them
+    :return: True if the file was or would have been removed
+    """
+    LOG.info(f'remove empty file "{file}"')
+
+    if not dry_run:
+        try:
+            os.remove(file)
+            cl.addChange(__name__,
+                         True,
+                         path=file)
+        except OSError as e:
+            LOG.error(f'failed to remove "{file}": {str(e)}')
+            cl.addChange(__name__,
+                         False,
+                         path=file,
+                         message=str(e),
+                         errno=e.errno)
+            return False
+    else:
+        cl.addChange(__name__,
+                     False,
+                     path=file)
+    return True
+
+
+def remove_directory(cl: ChangeLog, directory: str, dry_run: bool):
+    """
+    Remove an empty directory
+    :param cl: ChangeLog instance
+    :param directory: path to the directory
+    :param dry_run: True will not apply changes, only log them
+    :return: True if the directory was or would have been removed
+    """
+    LOG.info(f'remove empty directory "{directory}"')
+
+    if not dry_run:
+        try:
+            os.rmdir(directory)
+            cl.addChange(__name__,
+                         True,
+                         path=directory)
+        except OSError as e:
+            LOG.error(f'failed to remove "{directory}": {str(e)}')
+            cl.addChange(__name__,
+                         False,
+                         path=directory,
+                         message=str(e),
+                         errno=e.errno)
+            return False
+    else:
+        cl.addChange(__name__,
+                     False,
+                     path=directory)
+    return True
+
+
 def remove_empty(cl: ChangeLog,
                  directory,
                  dry_run,
-                 recursive):
-    for cd, dirs, files in os.walk(directory, followlinks=False):
-        files = [os.path.join(cd, f) for f in files]
-        for file in files:
-            size = os.stat(file).st_size
-
-            if size == 0:
-                LOG.info(f'remove empty file "{file}"')
-
-                if not dry_run:
-                    try:
-                        os.remove(file)
-                        cl.addChange(__name__,
-                                     True,
-                                     path=file)
-                    except OSError as e:
-                        LOG.error(f'failed to remove "{file}": {str(e)}')
-                        cl.addChange(__name__,
-                                     False,
-                                     path=file,
-                                     message=str(e),
-                                     errno=e.errno)
-                else:
-                    cl.addChange(__name__,
-                                 False,
-                                 path=file)
-        for sd in dirs:
-            sd_path = os.path.join(cd, sd)
-            if os.path.exists(sd_path):
-                content = []
+                 recursive,
+                 listings: list = None):
+    """
+    Remove empty files and directories
+    :param cl: ChangeLog instance
+    :param directory: directory to search
+    :param dry_run: True will not apply changes, only log them
+    :param recursive: True to recursively consider sub-directories
+    :param listings: optional list of walk_entries() results for `directory`
+    to use instead of walking it again, removed entries are taken out of it
+    """
+    def list_failed(e: OSError):
+        LOG.error(f'failed to list directory "{e.filename}": {str(e)}')
+        cl.addChange(__name__,
+                     False,
+                     path=e.filename,
+                     message=str(e),
+                     errno=e.errno)
+
+    if listings is None:
+        listings = list(walk_entries(directory,
+                                     recursive,
+                                     list_failed,
+                                     stat_files=True))
+    # directories that were or would have been removed
+    removed = set()
+
+    # sub-directories are listed after their parents, so going backwards
+    # handles them before the directory containing them
+    for cd, dirs, files in reversed(listings):
+        kept_files = []
+
+        for entry in files:
+            if entry.is_file(follow_symlinks=False) and \
+                    entry.stat(follow_symlinks=False).st_size == 0:
+                if remove_file(cl, entry.path, dry_run):
+                    continue
+
+            kept_files.append(entry)
+
+        if recursive:
+            kept_dirs = [sd for sd in dirs if sd.path not in removed]
+
+            if cd != directory and not kept_dirs and not kept_files:
+                if remove_directory(cl, cd, dry_run):
+                    removed.add(cd)
+        else:
+            kept_dirs = []
+
+            for sd in dirs:
                 try:
-                    content = os.listdir(sd_path)
+                    empty = is_empty(sd.path)
                 except OSError as e:
-                    LOG.error(f'failed to list directory "{sd_path}": {str(e)}')
-                    cl.addChange(__name__,
-                                 False,
-                                 path=sd_path,
-                                 message=str(e),
-                                 errno=e.errno)
-
-                if len(content) == 0:
-                    LOG.info(f'remove empty directory "{sd_path}"')
-
-                    if not dry_run:
-                        try:
-                            os.rmdir(sd_path)
-                            cl.addChange(__name__,
-                                         True,
-                                         path=sd_path)
-                        except OSError as e:
-                            LOG.error(f'failed to remove "{sd_path}": {str(e)}')
-                            cl.addChange(__name__,
-                                         False,
-                                         path=sd_path,
-                                         message=str(e),
-                                         errno=e.errno)
-                    else:
-                        cl.addChange(__name__,
-                                     False,
-                                     path=sd_path)
-        if not recursive:
-            break
+                    list_failed(e)
+                    empty = False
+
+                if not empty or not remove_directory(cl, sd.path, dry_run):
+                    kept_dirs.append(sd)
+
+        if not dry_run:
+            files[:] = kept_files
+            dirs[:] = kept_dirs
+
+    if not dry_run and removed:
+        listings[:] = [listing for listing in listings
+                       if listing[0] not in removed]
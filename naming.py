@@ -1,9 +1,10 @@
 import os
 import logging
-import pathlib
 import re
+import string
+import functools
 
-from common import ChangeLog
+from common import ChangeLog, walk_entries
 
 
 CAPITALIZED = 'capitalized'
@@ -13,6 +14,12 @@ UPPERCASE = 'uppercase'
 
 ADJACENT_PERIOD_PATTERN = re.compile(r'([^A-Z\d)\]])?\.([^A-Z\d(\[])?',
                                      flags=re.IGNORECASE)
+# characters ADJACENT_PERIOD_PATTERN leaves before and after a period, apart
+# from decimal digits. includes the non-ASCII letters that case-insensitively
+# match A-Z.
+PERIOD_NEIGHBOURS = string.ascii_letters + '\u0130\u0131\u017f\u212a'
+KEPT_BEFORE_PERIOD = frozenset(PERIOD_NEIGHBOURS + ')]')
+KEPT_AFTER_PERIOD = frozenset(PERIOD_NEIGHBOURS + '([')
 
 STYLE_NAMES = [
     CAPITALIZED,
@@ -20,111 +27,244 @@ STYLE_NAMES = [
     LOWERCASE,
     UPPERCASE
 ]
+STYLE_FUNCTIONS = {
+    CAPITALIZED: str.capitalize,
+    TITLECASE: str.title,
+    LOWERCASE: str.lower,
+    UPPERCASE: str.upper
+}
 
 STRIPPING_CHARS = " _-"
+FILENAME_CACHE_SIZE = 8192
+# os.rename() only refuses to replace an existing destination on Windows
+RENAME_REPLACES = os.name != 'nt'
+# files are renamed relative to an open directory where supported, sparing
+# the kernel from resolving the directory path again for every rename
+RENAME_AT = os.rename in os.supports_dir_fd and \
+    os.stat in os.supports_dir_fd and \
+    os.stat in os.supports_follow_symlinks
 LOG = logging.getLogger('fsclean.naming')
 
 
-def check_filename(filename: str, style=None, space_char=None):
+def collapse_period_adjacent(text: str):
     """
-    Parse a given filename for these consistency errors:
-    - Extraneous spaces
-    - Uppercase extension names
-    - Stripping beginning and end of STRIPPING_CHARS
-    - Anything but alphanumerics before or after "."
-    - Optionally enforce naming conventions
+    Remove anything but alphanumerics or facing brackets directly before and
+    after each period. Equivalent to substituting ADJACENT_PERIOD_PATTERN
+    with "." in a single scan without the regex engine.
+    :param text: input text
+    :return: the text with the characters around periods removed
+    """
+    i = text.find('.')
+
+    if i == -1:
+        return text
+
+    length = len(text)
+    parts = []
+    start = 0
+
+    while i != -1:
+        before = text[i - 1] if i > start else None
+        dot = i
+
+        if before is not None and before not in KEPT_BEFORE_PERIOD and \
+                not before.isdecimal():
+            # the character before the period goes
+            i -= 1
+        elif i + 1 < length and text[i + 1] == '.':
+            # a period may itself be the character before another
+            dot += 1
+
+        end = dot + 1
+
+        if end < length and text[end] not in KEPT_AFTER_PERIOD and \
+                not text[end].isdecimal():
+            end += 1
+
+        parts.append(text[start:i])
+        parts.append('.')
+        start = end
+        i = text.find('.', start)
+
+    parts.append(text[start:])
+    return ''.join(parts)
+
+
+def split_extension(filename: str):
+    """
+    Split a file name into stem and extension by its last period, following
+    the same rules as pathlib's stem and suffix
+    :param filename: input filename
+    :return: a tuple of (stem, extension)
+    """
+    i = filename.rfind('.')
+
+    if 0 < i < len(filename) - 1:
+        return filename[:i], filename[i:]
+    return filename, ''
+
+
+def correct_filename(filename: str, style=None, space_char=None,
+                     debug=False):
+    """
+    Correct a filename as described by check_filename()
     :param filename: input filename
     :param style: enforce a particular naming style
     (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
     :param space_char: replace spaces in a file name with this character
+    :param debug: True to log each correction made
     :return: a corrected filename
     """
-    pl_obj = pathlib.Path(filename)
-    name = pl_obj.stem
-    ext = pl_obj.suffix
+    name, ext = split_extension(filename)
 
     if name != '':
         name_stripped = name.strip(STRIPPING_CHARS)
 
-        if name_stripped != name:
-            LOG.debug('"{}": needed stripping'.format(filename))
+        if debug and name_stripped != name:
+            LOG.debug('"%s": needed stripping', filename)
 
-        name_spaces = ' '.join(name_stripped.split())
+        # str.split() whitespace is non-printable apart from the space itself,
+        # and strip() already removed spaces from both ends
+        if name_stripped.isprintable() and '  ' not in name_stripped:
+            name_spaces = name_stripped
+        else:
+            name_spaces = ' '.join(name_stripped.split())
 
-        if name_spaces != name_stripped:
-            LOG.debug('"{}": had extraneous spaces'.format(filename))
+        if debug and name_spaces != name_stripped:
+            LOG.debug('"%s": had extraneous spaces', filename)
 
         name = name_spaces
 
-        if style is not None:
-            if style == CAPITALIZED:
-                name_styled = name.capitalize()
-            elif style == TITLECASE:
-                name_styled = name.title()
-            elif style == LOWERCASE:
-                name_styled = name.lower()
-            elif style == UPPERCASE:
-                name_styled = name.upper()
-            else:
-                name_styled = name
+        style_function = STYLE_FUNCTIONS.get(style)
+
+        if style_function is not None:
+            name_styled = style_function(name)
 
-            if name_styled != name:
-                LOG.debug('"{}": naming style enforced'.format(filename))
+            if debug and name_styled != name:
+                LOG.debug('"%s": naming style enforced', filename)
 
             name = name_styled
 
         if space_char is not None:
             name_replaced = name.replace(' ', space_char)
 
-            if name_replaced != name:
-                LOG.debug('"{}": spaces replaced with "{}"'.format(filename,
-                                                                   space_char))
+            if debug and name_replaced != name:
+                LOG.debug('"%s": spaces replaced with "%s"',
+                          filename,
+                          space_char)
 
             name = name_replaced
 
-    ext_spaces = ext.replace(' ', '')
+    if ' ' in ext:
+        ext_spaces = ext.replace(' ', '')
 
-    if ext_spaces != ext:
-        LOG.debug('"{}": extension spaces removed'.format(filename))
+        if debug:
+            LOG.debug('"%s": extension spaces removed', filename)
+    else:
+        ext_spaces = ext
 
     ext_lowering = ext_spaces.lower()
 
-    if ext_lowering != ext_spaces:
-        LOG.debug('"{}": extension converted to lowercase'.format(filename))
+    if debug and ext_lowering != ext_spaces:
+        LOG.debug('"%s": extension converted to lowercase', filename)
 
     first_stage = name + ext_lowering
-    adjacent_other = ADJACENT_PERIOD_PATTERN.sub('.', first_stage)
+    adjacent_other = collapse_period_adjacent(first_stage)
 
-    if adjacent_other != first_stage:
-        pattern_text = ADJACENT_PERIOD_PATTERN.pattern
-        LOG.debug(f'"{filename}": removed chars adjacent to period matching '
-                  f'"{pattern_text}"')
+    if debug and adjacent_other != first_stage:
+        LOG.debug('"%s": removed chars adjacent to period matching "%s"',
+                  filename,
+                  ADJACENT_PERIOD_PATTERN.pattern)
 
     second_stage = adjacent_other
     return second_stage
 
 
+@functools.lru_cache(maxsize=FILENAME_CACHE_SIZE)
+def correct_filename_cached(filename: str, style=None, space_char=None):
+    """
+    Memoized correct_filename() without logging, the same names tend to
+    repeat across directories
+    :param filename: input filename
+    :param style: enforce a particular naming style
+    (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
+    :param space_char: replace spaces in a file name with this character
+    :return: a corrected filename
+    """
+    return correct_filename(filename, style, space_char)
+
+
+def check_filename(filename: str, style=None, space_char=None):
+    """
+    Parse a given filename for these consistency errors:
+    - Extraneous spaces
+    - Uppercase extension names
+    - Stripping beginning and end of STRIPPING_CHARS
+    - Anything but alphanumerics before or after "."
+    - Optionally enforce naming conventions
+    :param filename: input filename
+    :param style: enforce a particular naming style
+    (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
+    :param space_char: replace spaces in a file name with this character
+    :return: a corrected filename
+    """
+    if LOG.isEnabledFor(logging.DEBUG):
+        # cached results would skip logging the corrections
+        return correct_filename(filename, style, space_char, debug=True)
+    return correct_filename_cached(filename, style, space_char)
+
+
 def check_files(files: list, style=None, space_char=None):
     """
-    Generate a dictionary of files to be renamed and the new name
-    :param files: a list of file paths to check
+    Generate the files to be renamed and their new names
+    :param files: an iterable of file paths to check
     :param style: enforce a particular naming style
     (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
     :param space_char: replace spaces in a file name with this character
-    :return: A dictionary in form of {<path>: <new name>}
+    :return: a generator of (<path>, <new name>) tuples
     """
-    renamed = {}
+    if style is not None and style not in STYLE_FUNCTIONS:
+        raise ValueError(f'unknown naming style "{style}"')
+
+    debug = LOG.isEnabledFor(logging.DEBUG)
 
     for file in files:
         new_name = check_filename(file, style=style, space_char=space_char)
 
         if new_name != file:
-            renamed.update({file: new_name})
-            LOG.debug('"{}": to be renamed "{}"'.format(file, new_name))
-        else:
-            LOG.debug('"{}": no change'.format(file))
+            if debug:
+                LOG.debug('"%s": to be renamed "%s"', file, new_name)
 
-    return renamed
+            yield file, new_name
+        elif debug:
+            LOG.debug('"%s": no change', file)
+
+
+def exists_at(name: str, dir_fd: int):
+    """
+    Check if a directory entry exists, without following symbolic links
+    :param name: name of the entry
+    :param dir_fd: file descriptor of the directory containing it
+    :return: True if the entry exists
+    """
+    try:
+        os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def is_directory_link(entry: os.DirEntry):
+    """
+    Check if a directory entry is a symbolic link to a directory. os.walk()
+    lists those with the sub-directories, so they are not renamed.
+    :param entry: the directory entry
+    :return: True if the entry links to a directory
+    """
+    try:
+        return entry.is_symlink() and entry.is_dir()
+    except OSError:
+        return False
 
 
 def rename_files(cl: ChangeLog, directory: str, files: list, dry_run: bool,
@@ -133,7 +273,7 @@ def rename_files(cl: ChangeLog, directory: str, files: list, dry_run: bool,
     Check file names for inconsistency and rename
     :param cl: ChangeLog instance
     :param directory: directory the files are contained in
-    :param files: a list of file names
+    :param files: an iterable of file names
     :param dry_run: True will not apply changes, only log them
     :param style: enforce a particular naming style
     (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
@@ -142,38 +282,68 @@ def rename_files(cl: ChangeLog, directory: str, files: list, dry_run: bool,
 
     changes = check_files(files, style=style, space_char=space_char)
 
-    # iterate and apply changes
-    for of, nf in changes.items():
-        path = os.path.join(directory, of)
-        dest = os.path.join(directory, nf)
-        LOG.info('"{}": rename "{}"'.format(path, nf))
-
-        if not dry_run:
-            try:
-                if not os.path.exists(dest):
-                    os.rename(path, dest)
-                    cl.addChange(__name__, True, src=path, dest=dest)
-                else:
-                    LOG.warning('"{}": destination already exists'.format(path))
-                    cl.addChange(__name__,
-                                 False,
-                                 src=path,
-                                 dest=dest,
-                                 message='destination already exists')
-            except OSError as e:
-                LOG.error('failed to rename "{}": {}'.format(path, str(e)))
-                cl.addChange(__name__,
-                             False,
-                             src=path,
-                             dest=dest,
-                             message=str(e),
-                             errno=e.errno)
-        else:
-            cl.addChange(__name__, False, src=path, dest=dest)
+    # bound once, looked up for every file otherwise
+    join = os.path.join
+    exists = os.path.exists
+    rename = os.rename
+    info = LOG.info
+    # recorded in the change log together once the directory is done
+    records = []
+    record = records.append
+    # opened on the first rename
+    dir_fd = None
+
+    try:
+        # iterate and apply changes
+        for of, nf in changes:
+            path = join(directory, of)
+            dest = join(directory, nf)
+            info('"%s": rename "%s"', path, nf)
+
+            if not dry_run:
+                try:
+                    if RENAME_AT and dir_fd is None:
+                        dir_fd = os.open(directory,
+                                         os.O_RDONLY | os.O_DIRECTORY)
+
+                    if dir_fd is not None:
+                        if exists_at(nf, dir_fd):
+                            raise FileExistsError
+
+                        rename(of, nf, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+                    else:
+                        if RENAME_REPLACES and exists(dest):
+                            raise FileExistsError
+
+                        rename(path, dest)
+
+                    record((True, {'src': path, 'dest': dest}))
+                except FileExistsError:
+                    LOG.warning('"%s": destination already exists', path)
+                    record((False, {
+                        'src': path,
+                        'dest': dest,
+                        'message': 'destination already exists'
+                    }))
+                except OSError as e:
+                    LOG.error('failed to rename "%s": %s', path, str(e))
+                    record((False, {
+                        'src': path,
+                        'dest': dest,
+                        'message': str(e),
+                        'errno': e.errno
+                    }))
+            else:
+                record((False, {'src': path, 'dest': dest}))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+        cl.addChanges(__name__, records)
 
 
 def rename_dir(cl: ChangeLog, directory: str, dry_run: bool, recursive: bool,
-               style=None, space_char=None):
+               style=None, space_char=None, listings: list = None):
     """
     Check files in a directory for naming inconsistency and rename
     :param cl: ChangeLog instance
@@ -183,24 +353,24 @@ def rename_dir(cl: ChangeLog, directory: str, dry_run: bool, recursive: bool,
     :param style: enforce a particular naming style
     (CAPITALIZED, TITLECASE, LOWERCASE, UPPERCASE)
     :param space_char: replace spaces in a file name with this character
+    :param listings: optional list of walk_entries() results for `directory`
+    to use instead of walking it again
     """
 
-    try:
-        for cd, dirs, files in os.walk(directory, followlinks=False):
-            LOG.info(f'working in "{cd}" ({len(files)} files, '
-                     f'{len(dirs)} sub directories)')
-
-            rename_files(cl,
-                         cd,
-                         files,
-                         dry_run,
-                         style=style,
-                         space_char=space_char)
-
-            if recursive:
-                # check each sub-directory
-                for sub in dirs:
-                    rename_dir(cl, sub, dry_run, recursive)
-    except OSError as e:
-        LOG.error('failed to enumerate "{}": {}'.format(directory,
-                                                        str(e)))
+    def list_failed(e: OSError):
+        LOG.error(f'failed to enumerate "{e.filename}": {str(e)}')
+
+    if listings is None:
+        listings = walk_entries(directory, recursive, list_failed)
+
+    for cd, dirs, files in listings:
+        LOG.info(f'working in "{cd}" ({len(files)} files, '
+                 f'{len(dirs)} sub directories)')
+
+        rename_files(cl,
+                     cd,
+                     (entry.name for entry in files
+                      if not is_directory_link(entry)),
+                     dry_run,
+                     style=style,
+                     space_char=space_char)